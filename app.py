@@ -1,36 +1,60 @@
 from flask import Flask, render_template, session, redirect, request, jsonify
 from flask_cors import CORS
-from flask_session import Session
 from apscheduler.schedulers.background import BackgroundScheduler
 import google.generativeai as genai
 import os
-import json
- 
+import orjson
+import re
+import hashlib
+import time
+
 from config import SECRET_KEY, TOKENS_DIR, LABEL_NAME, GOOGLE_API_KEY
-from utils.auth import get_token_from_cache
-from utils.outlook import create_outlook_category, fetch_emails_with_mime, mark_email_with_category, extract_email_content
-from utils.calendar import create_calendar_event
+from utils.auth import get_token_from_cache, refresh_expiring_tokens, warm_msal_authority
+from utils.outlook import create_outlook_category, fetch_emails_with_mime, mark_emails_with_category_batch, extract_email_content
+from utils.calendar import create_calendar_events
 from utils.models import UserPreferences
 
 app = Flask(__name__)
 CORS(app, 
      supports_credentials=True,
+     origins="*",
      allow_headers=["Content-Type", "Authorization", "X-Requested-With"],
      methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"])
 
+# Sessions only hold the user id plus a little chat state, so Flask's
+# signed-cookie sessions are enough and skip the per-request file I/O the
+# old filesystem backend paid.
 app.secret_key = SECRET_KEY
-app.config['SESSION_TYPE'] = 'filesystem'
 app.config['SESSION_PERMANENT'] = True
-app.config['SESSION_USE_SIGNER'] = True
 app.config['SESSION_COOKIE_SECURE'] = False
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 app.config['PERMANENT_SESSION_LIFETIME'] = 86400
 
-Session(app)
-
 genai.configure(api_key=GOOGLE_API_KEY)
 
+# Gemini wraps JSON answers in markdown fences more often than not; one
+# compiled pattern pulls the payload out without chained str.split copies.
+_json_fence_pattern = re.compile(r'```(?:json)?\s*(.*?)\s*```', re.DOTALL)
+
+def extract_json_payload(response_text):
+    match = _json_fence_pattern.search(response_text)
+    return match.group(1) if match else response_text
+
+# Compiled interest patterns survive across scheduler ticks, keyed by the
+# interest list so a preferences change rebuilds the pattern.
+_interest_patterns = {}
+
+def get_interest_pattern(user_interests):
+    if not user_interests:
+        return None
+    key = tuple(user_interests)
+    pattern = _interest_patterns.get(key)
+    if pattern is None:
+        pattern = re.compile('|'.join(re.escape(interest) for interest in key), re.IGNORECASE)
+        _interest_patterns[key] = pattern
+    return pattern
+
 @app.route('/api/session', methods=['GET'])
 def check_session():
     if 'user_id' in session:
@@ -44,109 +68,237 @@ def check_session():
             "redirect": "/login"
         }), 401
 
-@app.after_request
-def after_request(response):
-    response.headers.add('Access-Control-Allow-Origin', request.headers.get('Origin', '*'))
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,X-Requested-With')
-    response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
-    response.headers.add('Access-Control-Allow-Credentials', 'true')
-    return response
-
-scheduler = BackgroundScheduler(daemon=True)
+scheduler = BackgroundScheduler(daemon=True, job_defaults={
+    'coalesce': True,
+    'max_instances': 1,
+    'misfire_grace_time': 300
+})
 scheduler.start()
 
-def process_emails():
-    for token_file in os.listdir(TOKENS_DIR):
-        if not token_file.endswith('.json') or '_preferences' in token_file:
+GEMINI_BATCH_SIZE = 20
+
+def load_user_cursor(user_id):
+    cursor_path = os.path.join(TOKENS_DIR, f"{user_id}_cursor.json")
+    try:
+        with open(cursor_path, 'rb') as f:
+            return orjson.loads(f.read()).get('last_received')
+    except Exception:
+        return None
+
+def save_user_cursor(user_id, last_received):
+    cursor_path = os.path.join(TOKENS_DIR, f"{user_id}_cursor.json")
+    try:
+        with open(cursor_path, 'wb') as f:
+            f.write(orjson.dumps({'last_received': last_received}))
+    except Exception:
+        pass
+
+def prepare_user_email(email, interest_pattern):
+    """Classify an email, returning (mark_entry, pending_entry).
+
+    mark_entry is an (id, categories) pair for the batched category PATCH;
+    pending_entry is the payload for Gemini extraction when the email matches
+    the user's interests."""
+    categories = email.get('categories') or ()
+    if LABEL_NAME in categories:
+        return None, None
+    email_id = email['id']
+    subject = email['subject']
+    sender = email['sender']
+    mark_entry = (email_id, categories)
+    if interest_pattern and not interest_pattern.search(subject):
+        # Subject missed: extract a few KB of body text for the second-level
+        # match (extract_email_content caps the work for huge HTML emails)
+        content = extract_email_content(email['content'], email.get('bodyType', 'text'))
+        if not interest_pattern.search(content):
+            return mark_entry, None
+        content = content[:1000]
+    else:
+        # Subject matched (or no filter): only the Gemini budget is needed
+        content = extract_email_content(email['content'], email.get('bodyType', 'text'), max_chars=1000)
+    return mark_entry, {'id': email_id, 'subject': subject, 'sender': sender, 'content': content}
+
+# The extraction instructions are constant, so they live on the model as a
+# system instruction: each batch request carries only the email payload.
+# (Gemini's explicit context caching wants a ~32k-token prefix, far larger
+# than this prompt, so a system instruction is the right tool at this size.)
+_EXTRACTION_INSTRUCTION = """
+    You analyze emails for dates, deadlines, meetings, or events that should be
+    added to a calendar. The user message is a JSON array of emails, each with
+    an id, subject, and content.
+    Respond with a JSON array containing one object per email, in the same order:
+    [
+        {
+            "id": "the email id",
+            "has_events": true,
+            "events": [
+                {
+                    "title": "Event title",
+                    "date": "YYYY-MM-DD",
+                    "time": "HH:MM" (if specified, otherwise "09:00"),
+                    "description": "Brief description"
+                }
+            ]
+        }
+    ]
+    For emails with no calendar items, use: {"id": "the email id", "has_events": false}
+    Only extract real dates and events, not hypothetical ones.
+    """
+
+extraction_model = genai.GenerativeModel('gemini-1.5-flash', system_instruction=_EXTRACTION_INSTRUCTION)
+
+def extract_events_batch(pending):
+    """Run calendar extraction for a batch of emails in one Gemini call."""
+    payload = orjson.dumps([
+        {'id': item['id'], 'subject': item['subject'], 'content': item['content']}
+        for item in pending
+    ]).decode()
+    response = extraction_model.generate_content(payload)
+    ai_result = extract_json_payload(response.text.strip())
+    return orjson.loads(ai_result)
+
+# Newsletters and re-delivered notifications repeat the same content, and an
+# overlapping tick can see an email before its category sticks; remember what
+# Gemini said about identical content for a day so those calls are free.
+_extraction_cache = {}
+EXTRACTION_CACHE_TTL = 86400
+EXTRACTION_CACHE_MAX = 1024
+
+def _prune_extraction_cache(now):
+    # TTL was only checked on lookup, so distinct emails accumulated
+    # forever; drop expired entries once the cache is big, then fall back
+    # to oldest-insertion eviction like the token cache
+    if len(_extraction_cache) <= EXTRACTION_CACHE_MAX:
+        return
+    expired = [key for key, (ts, _) in _extraction_cache.items()
+               if now - ts >= EXTRACTION_CACHE_TTL]
+    for key in expired:
+        _extraction_cache.pop(key, None)
+    while len(_extraction_cache) > EXTRACTION_CACHE_MAX:
+        _extraction_cache.pop(next(iter(_extraction_cache)), None)
+
+def extraction_cache_key(item):
+    raw = f"{item['subject']}\x00{item['content']}".encode()
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+def schedule_user_events(user_id, pending):
+    emails_by_id = {item['id']: item for item in pending}
+    now = time.time()
+    _prune_extraction_cache(now)
+    results = []
+    uncached = []
+    for item in pending:
+        cached = _extraction_cache.get(extraction_cache_key(item))
+        if cached and now - cached[0] < EXTRACTION_CACHE_TTL:
+            results.append({'id': item['id'], **cached[1]})
+        else:
+            uncached.append(item)
+    for batch_start in range(0, len(uncached), GEMINI_BATCH_SIZE):
+        batch = uncached[batch_start:batch_start + GEMINI_BATCH_SIZE]
+        try:
+            batch_results = extract_events_batch(batch)
+        except Exception as ai_error:
             continue
-        user_id = token_file.split('.')[0]
-        access_token = get_token_from_cache(user_id)
-        if not access_token:
+        for result in batch_results:
+            email = emails_by_id.get(result.get('id'))
+            if email:
+                _extraction_cache[extraction_cache_key(email)] = (now, {
+                    'has_events': result.get('has_events', False),
+                    'events': result.get('events', [])
+                })
+            results.append(result)
+    event_specs = []
+    for result in results:
+        email = emails_by_id.get(result.get('id'))
+        if not email or not result.get('has_events', False):
             continue
+        for event_data in result.get('events', []):
+            event_specs.append({
+                'subject': event_data['title'],
+                'sender': email['sender'],
+                'date_str': event_data['date'],
+                'iso_date': f"{event_data['date']}T{event_data.get('time', '09:00')}:00",
+                'description': f"From email: {email['subject']}\n\n{event_data.get('description', '')}"
+            })
+    if event_specs:
         try:
-            with open(os.path.join(TOKENS_DIR, f"{user_id}_preferences.json"), 'r') as f:
-                user_preferences = json.loads(f.read())
-            if not user_preferences.get('enabled', True):
-                continue
-            user_interests = user_preferences.get('interests', [])
-            category_name = create_outlook_category(access_token, LABEL_NAME)
-            if not category_name:
-                continue
-            emails = fetch_emails_with_mime(user_id, days=1)
-            if not emails or isinstance(emails, dict) and 'error' in emails:
-                continue
-            for email in emails:
-                if isinstance(email, dict) and 'error' in email:
-                    continue
-                if LABEL_NAME in email.get('categories', []):
-                    continue
-                email_id = email['id']
-                subject = email['subject']
-                sender = email['sender']
-                content = extract_email_content(email['content'], email.get('bodyType', 'text'))
-                received_date = email['receivedDateTime']
-                if user_interests:
-                    matches_interest = False
-                    email_content = f"{subject} {content}".lower()
-                    for interest in user_interests:
-                        if interest.lower() in email_content:
-                            matches_interest = True
-                            break
-                    if not matches_interest:
-                        mark_email_with_category(access_token, email_id, LABEL_NAME)
-                        continue
-                mark_email_with_category(access_token, email_id, LABEL_NAME)
-                try:
-                    import google.generativeai as genai
-                    model = genai.GenerativeModel('gemini-1.5-flash')
-                    prompt = f"""
-                    Analyze this email for any dates, deadlines, meetings, or events that should be added to a calendar.
-                    Email Subject: {subject}
-                    Email Content: {content[:1000]}
-                    If there are any calendar-worthy items, respond with JSON in this format:
-                    {{
-                        "has_events": true,
-                        "events": [
-                            {{
-                                "title": "Event title",
-                                "date": "YYYY-MM-DD",
-                                "time": "HH:MM" (if specified, otherwise "09:00"),
-                                "description": "Brief description"
-                            }}
-                        ]
-                    }}
-                    If no calendar items found, respond with: {{"has_events": false}}
-                    Only extract real dates and events, not hypothetical ones.
-                    """
-                    response = model.generate_content(prompt)
-                    ai_result = response.text.strip()
-                    try:
-                        if ai_result.startswith('```json'):
-                            ai_result = ai_result.split('```json')[1].split('```')[0].strip()
-                        elif ai_result.startswith('```'):
-                            ai_result = ai_result.split('```')[1].strip()
-                        calendar_data = json.loads(ai_result)
-                        if calendar_data.get('has_events', False):
-                            for event_data in calendar_data.get('events', []):
-                                try:
-                                    event_result = create_calendar_event(
-                                        user_id=user_id,
-                                        subject=event_data['title'],
-                                        sender=sender,
-                                        date_str=event_data['date'],
-                                        iso_date=f"{event_data['date']}T{event_data.get('time', '09:00')}:00",
-                                        description=f"From email: {subject}\n\n{event_data.get('description', '')}"
-                                    )
-                                except Exception as event_error:
-                                    pass
-                    except json.JSONDecodeError as json_error:
-                        pass
-                except Exception as ai_error:
-                    pass
-        except Exception as e:
+            create_calendar_events(user_id, event_specs)
+        except Exception as event_error:
             pass
 
-scheduler.add_job(func=process_emails, trigger='interval', minutes=50)
+def process_user(user_id):
+    access_token = get_token_from_cache(user_id)
+    if not access_token:
+        return
+    try:
+        user_preferences = UserPreferences.load_preferences(user_id)
+        if not user_preferences.get('enabled', True):
+            return
+        interest_pattern = get_interest_pattern(user_preferences.get('interests', []))
+        category_name = create_outlook_category(access_token, LABEL_NAME)
+        if not category_name:
+            return
+        # oldest_first: the cursor below advances past max(receivedDateTime)
+        # of this result, which is only safe when truncation keeps the oldest
+        # unprocessed messages rather than the newest
+        emails = fetch_emails_with_mime(user_id, days=1, since=load_user_cursor(user_id),
+                                        include_mime=False, oldest_first=True)
+        if not emails:
+            return
+        last_received = max((email.get('receivedDateTime', '') for email in emails), default='')
+        to_mark = []
+        pending = []
+        for email in emails:
+            mark_entry, pending_entry = prepare_user_email(email, interest_pattern)
+            if mark_entry:
+                to_mark.append(mark_entry)
+            if pending_entry:
+                pending.append(pending_entry)
+        if to_mark:
+            mark_emails_with_category_batch(access_token, to_mark, LABEL_NAME)
+        if pending:
+            schedule_user_events(user_id, pending)
+        if last_received:
+            save_user_cursor(user_id, last_received)
+    except Exception as e:
+        pass
+
+def list_user_ids():
+    user_ids = []
+    with os.scandir(TOKENS_DIR) as entries:
+        for entry in entries:
+            if not entry.is_file() or not entry.name.endswith('.json') or '_preferences' in entry.name or '_cursor' in entry.name or '_calendar_delta' in entry.name:
+                continue
+            user_ids.append(entry.name.rpartition('.')[0])
+    return user_ids
+
+def sync_user_jobs():
+    """Keep one scheduled job per signed-in user so a slow user only delays
+    their own run. Existing jobs are left untouched: re-adding an interval
+    job resets its next_run_time, so a replace_existing re-sync every 10
+    minutes would push every 50-minute tick out forever and no job would
+    ever fire. Only new logins get a job; users whose token file is gone
+    have theirs removed."""
+    current_users = set(list_user_ids())
+    for user_id in current_users:
+        if scheduler.get_job(f'process_{user_id}') is None:
+            scheduler.add_job(
+                func=process_user,
+                args=[user_id],
+                trigger='interval',
+                minutes=50,
+                jitter=600,
+                id=f'process_{user_id}'
+            )
+    for job in scheduler.get_jobs():
+        if job.id.startswith('process_') and job.id[len('process_'):] not in current_users:
+            scheduler.remove_job(job.id)
+
+sync_user_jobs()
+scheduler.add_job(func=sync_user_jobs, trigger='interval', minutes=10, id='sync_user_jobs')
+scheduler.add_job(func=refresh_expiring_tokens, trigger='interval', minutes=1, id='refresh_tokens')
+# One-shot: warm MSAL's authority metadata off the request path
+scheduler.add_job(func=warm_msal_authority, id='warm_msal')
 
 from routes.auth_routes import auth_bp
 from routes.chat_routes import chat_bp
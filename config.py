@@ -9,9 +9,22 @@ IS_PRODUCTION = os.getenv('RENDER') is not None or os.getenv('PRODUCTION') == 't
 if not IS_PRODUCTION:
     os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
 
-SECRET_KEY = os.getenv('SECRET_KEY', os.urandom(24))
 TOKENS_DIR = "tokens"
 KEY_FILE = "secret.key"
+SESSION_KEY_FILE = "session_secret.key"
+
+# Fall back to a key persisted on disk rather than a fresh os.urandom value,
+# otherwise every restart invalidates all signed session cookies and forces
+# everyone back through the Microsoft consent flow.
+SECRET_KEY = os.getenv('SECRET_KEY')
+if not SECRET_KEY:
+    if os.path.exists(SESSION_KEY_FILE):
+        with open(SESSION_KEY_FILE, 'rb') as f:
+            SECRET_KEY = f.read()
+    else:
+        SECRET_KEY = os.urandom(24)
+        with open(SESSION_KEY_FILE, 'wb') as f:
+            f.write(SECRET_KEY)
 LABEL_NAME = "AddedToCalendar"
 
 CLIENT_ID = "8080fa82-1354-4d72-af67-da194392aa4a"
@@ -1,5 +1,5 @@
 from flask import Blueprint, jsonify, session, redirect, request, current_app
-from utils.calendar import fetch_calendar_events, delete_calendar_event
+from utils.calendar import fetch_calendar_events, delete_calendar_event, delete_calendar_events
 from utils.auth import require_auth
 
 calendar_bp = Blueprint('calendar', __name__)
@@ -29,6 +29,10 @@ def delete_calendar_event_route():
         user_id = session.get('user_id')
         if not user_id:
             return jsonify({"error": "Authentication required", "redirect": "/login"}), 401
+        event_ids = request.json.get('event_ids')
+        if event_ids:
+            results = delete_calendar_events(user_id, event_ids)
+            return jsonify({"success": True, "results": results})
         event_id = request.json.get('event_id')
         if not event_id:
             return jsonify({"error": "Event ID is required"}), 400
@@ -8,20 +8,36 @@ from utils.models import UserPreferences
 from utils.calendar import fetch_calendar_events, create_calendar_event, delete_calendar_event
 import json
 from datetime import datetime, timedelta, time
+from dateutil import parser as date_parser
 import traceback
 
 
 import re
 import os
 import pytz
-from google.generativeai import GenerativeModel
+import ciso8601
 from functools import wraps
 
 chat_bp = Blueprint('chat', __name__)
 
-# Configure the Generative AI model
+# /addsuggestion makes one blocking Gemini call per surviving email; with the
+# listing returning up to 100 messages, an uncapped loop could spend minutes
+# of request time (and 10x the quota) on a single click.
+SUGGESTION_AI_LIMIT = 10
+
+# Gemini usually wraps JSON answers in markdown fences; one compiled pattern
+# extracts the payload without the chained str.split copies.
+_json_fence_pattern = re.compile(r'```(?:json)?\s*(.*?)\s*```', re.DOTALL)
+
+def extract_json_payload(response_text):
+    match = _json_fence_pattern.search(response_text)
+    return match.group(1) if match else response_text
+
+# Configure the Generative AI model once; the model object is stateless for
+# our use, so every route shares this instance instead of rebuilding one.
 genai.configure(api_key=GOOGLE_API_KEY)
-model = genai.GenerativeModel("gemini-1.5-flash")
+GEMINI_MODEL_NAME = os.environ.get('GEMINI_MODEL', 'gemini-1.5-flash')
+model = genai.GenerativeModel(GEMINI_MODEL_NAME)
 
 @chat_bp.route('/chat', methods=['POST'])
 @require_auth
@@ -90,15 +106,12 @@ def chat():
                         }
                     })
                 except Exception as e:
-                    current_app.logger.error(f"Error creating event from suggestion: {str(e)}")
+                    current_app.logger.error("Error creating event from suggestion: %s", str(e))
                     return jsonify({
                         "response": f"I encountered an error adding the event to your calendar: {str(e)}",
                         "command_detected": True
                     })
         
-        # Get data for AI assistant - no longer need credentials
-        model = GenerativeModel(os.environ.get('GEMINI_MODEL', 'gemini-1.5-flash'))
-        
         # Check for commands
         is_command = False
         command_type = None
@@ -121,7 +134,7 @@ def chat():
                 is_command = True
                 command_type = command
                 command_content = user_message[len(prefix):].strip()
-                current_app.logger.info(f"Detected command: {command_type}, content: {command_content}")
+                current_app.logger.info("Detected command: %s, content: %s", command_type, command_content)
                 break
         
         # Process commands
@@ -155,7 +168,7 @@ def chat():
             return jsonify({"error": "Empty response from AI model"}), 500
         return jsonify({"response": response.text.strip(), "command_detected": False})
     except Exception as e:
-        current_app.logger.error(f"Chat error: {str(e)}")
+        current_app.logger.error("Chat error: %s", str(e))
         current_app.logger.error(traceback.format_exc())
         return jsonify({"error": "Internal server error"}), 500
 
@@ -180,7 +193,7 @@ def process_command(command_type, command_content, user_id):
                 "command_detected": True
             })
     except Exception as e:
-        current_app.logger.error(f"Command processing error: {str(e)}")
+        current_app.logger.error("Command processing error: %s", str(e))
         current_app.logger.error(traceback.format_exc())
         return jsonify({
             "response": f"I encountered an error processing your command: {str(e)}",
@@ -224,15 +237,9 @@ def add_event_command(command_content, user_id):
     try:
         response = model.generate_content(prompt)
         response_text = response.text.strip()
-        current_app.logger.info(f"AI response for date extraction: {response_text}")
+        current_app.logger.info("AI response for date extraction: %s", response_text)
         
-        # Extract JSON from response if needed
-        if "```json" in response_text:
-            json_str = response_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in response_text:
-            json_str = response_text.split("```")[1].strip()
-        else:
-            json_str = response_text
+        json_str = extract_json_payload(response_text)
             
         event_data = json.loads(json_str)
         
@@ -243,8 +250,7 @@ def add_event_command(command_content, user_id):
         
         # Parse the date
         try:
-            from dateutil import parser
-            event_dt = parser.parse(date_str)
+            event_dt = date_parser.parse(date_str)
             
             # Ensure the event is not defaulting to a future year if not explicitly specified
             current_year = datetime.now().year
@@ -256,22 +262,22 @@ def add_event_command(command_content, user_id):
                 if str(event_dt.year) not in date_str:
                     # Year wasn't explicitly mentioned, so default to current year
                     event_dt = event_dt.replace(year=current_year)
-                    current_app.logger.info(f"Adjusted year to current year: {event_dt}")
+                    current_app.logger.info("Adjusted year to current year: %s", event_dt)
                     
                     # If this makes the date in the past, and it's not today, assume it's for next year
                     now = datetime.now()
                     if event_dt < now and event_dt.date() != now.date():
                         event_dt = event_dt.replace(year=current_year + 1)
-                        current_app.logger.info(f"Date was in the past, adjusted to next year: {event_dt}")
+                        current_app.logger.info("Date was in the past, adjusted to next year: %s", event_dt)
             
-            current_app.logger.info(f"Parsed date: {date_str} -> {event_dt}")
+            current_app.logger.info("Parsed date: %s -> %s", date_str, event_dt)
             
         except Exception as date_error:
-            current_app.logger.error(f"Error parsing date: {date_error}, using default date")
+            current_app.logger.error("Error parsing date: %s, using default date", date_error)
             # Default to tomorrow 9am
             event_dt = datetime.now() + timedelta(days=1)
             event_dt = event_dt.replace(hour=9, minute=0, second=0, microsecond=0)
-            current_app.logger.info(f"Using default date: {event_dt}")
+            current_app.logger.info("Using default date: %s", event_dt)
         
         # Check for email ID in the command
         email_id = None
@@ -282,7 +288,7 @@ def add_event_command(command_content, user_id):
                 if email_match:
                     email_id = email_match.group(1)
             except Exception as e:
-                current_app.logger.error(f"Error extracting email ID: {str(e)}")
+                current_app.logger.error("Error extracting email ID: %s", str(e))
         
         # Create description
         description = f"Created via RunDown Chatbot\n\n"
@@ -295,7 +301,7 @@ def add_event_command(command_content, user_id):
             
         # Create calendar event
         iso_date = event_dt.isoformat()
-        current_app.logger.info(f"Creating event with ISO date: {iso_date}")
+        current_app.logger.info("Creating event with ISO date: %s", iso_date)
         event = create_calendar_event(
             user_id, 
             title, 
@@ -329,7 +335,7 @@ def add_event_command(command_content, user_id):
             }
         })
     except Exception as e:
-        current_app.logger.error(f"Error adding event: {str(e)}")
+        current_app.logger.error("Error adding event: %s", str(e))
         current_app.logger.error(traceback.format_exc())
         return jsonify({
             "response": f"I had trouble adding that event. Please try again with a clearer date and time.",
@@ -398,8 +404,7 @@ def remove_event_command(command_content, user_id):
                 start = event.get("start", {}).get("dateTime", "Unknown time")
                 
                 try:
-                    from dateutil import parser
-                    dt = parser.parse(start)
+                    dt = date_parser.parse(start)
                     formatted_date = dt.strftime("%A, %B %d at %I:%M %p")
                 except:
                     formatted_date = start
@@ -424,7 +429,7 @@ def remove_event_command(command_content, user_id):
                 ]
             })
     except Exception as e:
-        current_app.logger.error(f"Error removing event: {str(e)}")
+        current_app.logger.error("Error removing event: %s", str(e))
         current_app.logger.error(traceback.format_exc())
         return jsonify({
             "response": f"I encountered an error trying to remove that event: {str(e)}",
@@ -449,8 +454,7 @@ def list_events_command(user_id):
             start = event.get("start", {}).get("dateTime", "Unknown time")
             
             try:
-                from dateutil import parser
-                dt = parser.parse(start)
+                dt = date_parser.parse(start)
                 formatted_date = dt.strftime("%A, %B %d at %I:%M %p")
             except:
                 formatted_date = start
@@ -467,7 +471,7 @@ def list_events_command(user_id):
             "events": events[:8]
         })
     except Exception as e:
-        current_app.logger.error(f"Error listing events: {str(e)}")
+        current_app.logger.error("Error listing events: %s", str(e))
         current_app.logger.error(traceback.format_exc())
         return jsonify({
             "response": f"I encountered an error trying to list your events: {str(e)}",
@@ -520,7 +524,7 @@ def add_suggestion():
         
         # Check if fetch_emails returned an error
         if isinstance(emails, dict) and 'error' in emails:
-            current_app.logger.error(f"Failed to fetch emails: {emails.get('error', 'Unknown error')}")
+            current_app.logger.error("Failed to fetch emails: %s", emails.get('error', 'Unknown error'))
             return jsonify({
                 "status": "error",
                 "message": f"Failed to fetch emails: {emails.get('message', emails.get('error', 'Unknown error'))}",
@@ -530,7 +534,7 @@ def add_suggestion():
         
         # Ensure emails is a list
         if not isinstance(emails, list):
-            current_app.logger.error(f"Expected list of emails, got: {type(emails)}")
+            current_app.logger.error("Expected list of emails, got: %s", type(emails))
             return jsonify({
                 "status": "error", 
                 "message": "Failed to fetch emails - invalid response format",
@@ -538,6 +542,44 @@ def add_suggestion():
                 "markdown": True
             })
         
+        # Get user preferences for filtering
+        user_preferences = UserPreferences.load_preferences(user_id)
+        user_interests = user_preferences.get('interests', [])
+        filtering_enabled = user_preferences.get('enabled', True)
+        
+        filtered_emails = []
+        suggestions = []
+        
+        # Only apply filtering if user has preferences and filtering is enabled
+        if filtering_enabled and user_interests:
+            current_app.logger.info("Filtering emails based on user interests: %s", user_interests)
+            
+            # Filter emails based on user interests; lower the interests once
+            # and only lower the (potentially large) body if the subject misses
+            lowered_interests = [interest.lower() for interest in user_interests]
+            for email in emails:
+                subject_lower = email.get('subject', '').lower()
+                content_lower = None
+                for interest in lowered_interests:
+                    if interest in subject_lower:
+                        filtered_emails.append(email)
+                        break
+                    if content_lower is None:
+                        content_lower = email.get('content', '')[:4096].lower()
+                    if interest in content_lower:
+                        filtered_emails.append(email)
+                        break
+            
+            current_app.logger.info("Filtered %s emails from %s total", len(filtered_emails), len(emails))
+        else:
+            # No filtering needed
+            filtered_emails = emails
+        
+        # Nothing survived the filter (or the inbox was empty): skip the
+        # calendar fetch and the AI calls entirely
+        if not filtered_emails:
+            return jsonify({"suggestions": []})
+        
         # Fetch existing calendar events to check for duplicates
         calendar_events = fetch_calendar_events(user_id)
         existing_event_titles = [event.get('summary', '').lower() for event in calendar_events]
@@ -561,32 +603,8 @@ def add_suggestion():
                     subject = subject_line[0].replace('Subject:', '').strip()
                     existing_subjects[subject.lower()] = True
         
-        # Get user preferences for filtering
-        user_preferences = UserPreferences.load_preferences(user_id)
-        user_interests = user_preferences.get('interests', [])
-        filtering_enabled = user_preferences.get('enabled', True)
-        
-        filtered_emails = []
-        suggestions = []
-        
-        # Only apply filtering if user has preferences and filtering is enabled
-        if filtering_enabled and user_interests:
-            current_app.logger.info(f"Filtering emails based on user interests: {user_interests}")
-            
-            # Filter emails based on user interests
-            for email in emails:
-                email_content = f"{email.get('subject', '')} {email.get('content', '')}".lower()
-                for interest in user_interests:
-                    if interest.lower() in email_content:
-                        filtered_emails.append(email)
-                        break
-            
-            current_app.logger.info(f"Filtered {len(filtered_emails)} emails from {len(emails)} total")
-        else:
-            # No filtering needed
-            filtered_emails = emails
-        
         # Process emails (filtered or all)
+        ai_calls = 0
         for email in filtered_emails:
             email_id = email.get('id', '')
             email_subject = email.get('subject', 'No Subject')
@@ -594,14 +612,21 @@ def add_suggestion():
             
             # Skip if the email subject is already in calendar events or already processed
             if email_subject.lower() in existing_subjects:
-                current_app.logger.info(f"Skipping already processed email: {email_subject}")
+                current_app.logger.info("Skipping already processed email: %s", email_subject)
                 continue
                 
             # Skip if the email title exactly matches an existing event
             if any(email_subject.lower() == title for title in existing_event_titles):
-                current_app.logger.info(f"Skipping email with title already in calendar: {email_subject}")
+                current_app.logger.info("Skipping email with title already in calendar: %s", email_subject)
                 continue
             
+            # The listing is newest-first, so the cap keeps the most recent
+            # candidates and drops the tail instead of blocking the request
+            if ai_calls >= SUGGESTION_AI_LIMIT:
+                current_app.logger.info("Reached suggestion AI limit (%s), skipping remaining emails", SUGGESTION_AI_LIMIT)
+                break
+            ai_calls += 1
+            
             prompt = f"""
             **Email Subject:** {email_subject}
             **Email Content:** {email_content}
@@ -633,14 +658,8 @@ def add_suggestion():
             
             if response and response.text.strip():
                 try:
-                    # Extract JSON from response
                     response_text = response.text.strip()
-                    if "```json" in response_text:
-                        json_str = response_text.split("```json")[1].split("```")[0].strip()
-                    elif "```" in response_text:
-                        json_str = response_text.split("```")[1].strip()
-                    else:
-                        json_str = response_text
+                    json_str = extract_json_payload(response_text)
                     
                     suggestion_data = json.loads(json_str)
                     
@@ -649,12 +668,12 @@ def add_suggestion():
                     
                     # Skip if the task is "FYI" or doesn't seem like an actionable task
                     if task_text.startswith("FYI:") or not task_text:
-                        current_app.logger.info(f"Skipping non-actionable task: {task_text}")
+                        current_app.logger.info("Skipping non-actionable task: %s", task_text)
                         continue
                         
                     # Skip if the task exactly matches an existing event title
                     if any(task_text.lower() == title for title in existing_event_titles):
-                        current_app.logger.info(f"Skipping task already in calendar: {task_text}")
+                        current_app.logger.info("Skipping task already in calendar: %s", task_text)
                         continue
                     
                     # Get the event date - look for event_date first (new format) then deadline (old format)
@@ -670,8 +689,7 @@ def add_suggestion():
                         except ValueError:
                             try:
                                 # Try with dateutil parser as fallback
-                                from dateutil import parser
-                                dt = parser.parse(event_date)
+                                dt = date_parser.parse(event_date)
                                 formatted_deadline = dt.strftime("%b %d, %Y at %I:%M %p")
                             except:
                                 # Just use as is if parsing fails
@@ -690,7 +708,7 @@ def add_suggestion():
                     
                 except Exception as json_error:
                     # Fallback if JSON parsing fails
-                    current_app.logger.error(f"Error parsing AI response: {json_error}")
+                    current_app.logger.error("Error parsing AI response: %s", json_error)
                     current_app.logger.error(traceback.format_exc())
                     suggestions.append({
                         "text": response.text.strip(),
@@ -701,10 +719,10 @@ def add_suggestion():
         # Sort suggestions by time sensitivity
         suggestions.sort(key=lambda x: x.get('is_time_sensitive', False), reverse=True)
         
-        current_app.logger.info(f"Generated {len(suggestions)} suggestions")
+        current_app.logger.info("Generated %s suggestions", len(suggestions))
         return jsonify({"suggestions": suggestions})
     except Exception as e:
-        current_app.logger.error(f"Add suggestion error: {str(e)}")
+        current_app.logger.error("Add suggestion error: %s", str(e))
         current_app.logger.error(traceback.format_exc())
         return jsonify({"error": "Internal server error"}), 500
 
@@ -725,7 +743,7 @@ def add_task():
             original_event_date = data.get('event_date')
             display_date = data.get('display_date')
             
-            print(f"Received task with original_event_date: {original_event_date}, display_date: {display_date}")
+            current_app.logger.debug("Received task with original_event_date: %s, display_date: %s", original_event_date, display_date)
         else:
             # Handle plain text request from manual entry
             task_desc = request.data.decode('utf-8')
@@ -734,12 +752,11 @@ def add_task():
         
         # Use the original event date if available, otherwise ask AI to extract
         if original_event_date and original_event_date.lower() != 'none':
-            print(f"Using original event date from suggestion: {original_event_date}")
+            current_app.logger.debug("Using original event date from suggestion: %s", original_event_date)
             # Parse the original date
             try:
-                from dateutil import parser
-                dt = parser.parse(original_event_date)
-                print(f"Successfully parsed original event date: {original_event_date} -> {dt}")
+                dt = date_parser.parse(original_event_date)
+                current_app.logger.debug("Successfully parsed original event date: %s -> %s", original_event_date, dt)
                 
                 # Check if the year wasn't explicitly specified
                 current_year = datetime.now().year
@@ -749,9 +766,9 @@ def add_task():
                     now = datetime.now()
                     if dt < now and dt.date() != now.date():
                         dt = dt.replace(year=current_year + 1)
-                        print(f"Adjusted to next year: {dt}")
+                        current_app.logger.debug("Adjusted to next year: %s", dt)
                     else:
-                        print(f"Adjusted to current year: {dt}")
+                        current_app.logger.debug("Adjusted to current year: %s", dt)
                 
                 # Build a title and description
                 title = task_desc
@@ -759,7 +776,7 @@ def add_task():
                 
                 # Create the calendar event - no Z suffix to avoid UTC designation
                 iso_date = dt.isoformat()
-                print(f"Creating event with ISO date from original event date: {iso_date}")
+                current_app.logger.debug("Creating event with ISO date from original event date: %s", iso_date)
                 
                 event = create_calendar_event(
                     user_id, 
@@ -780,12 +797,12 @@ def add_task():
                     "deadline": formatted_deadline
                 })
             except Exception as e:
-                print(f"Error parsing original event date: {e}, falling back to AI extraction")
+                current_app.logger.error("Error parsing original event date: %s, falling back to AI extraction", e)
                 # Fall back to AI extraction
                 original_event_date = None
         
         # If we get here, we need to use AI to extract information
-        print(f"Using AI to extract date from task: {task_desc}")
+        current_app.logger.debug("Using AI to extract date from task: %s", task_desc)
         
         # Use AI to parse the task and get information
         prompt = f"""
@@ -818,15 +835,9 @@ def add_task():
         # Parse the response
         try:
             response_text = response.text.strip()
-            print(f"AI response: {response_text}")
+            current_app.logger.debug("AI response: %s", response_text)
             
-            # Extract JSON from response if needed
-            if "```json" in response_text:
-                json_str = response_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in response_text:
-                json_str = response_text.split("```")[1].strip()
-            else:
-                json_str = response_text
+            json_str = extract_json_payload(response_text)
                 
             task_data = json.loads(json_str)
             title = task_data.get("title", task_desc)
@@ -838,8 +849,7 @@ def add_task():
                 date_str = task_data.get("date")
                 if date_str:
                     # Try to parse the date
-                    from dateutil import parser
-                    dt = parser.parse(date_str)
+                    dt = date_parser.parse(date_str)
                     
                     # Check if the year wasn't explicitly specified
                     current_year = datetime.now().year
@@ -849,22 +859,22 @@ def add_task():
                         now = datetime.now()
                         if dt < now and dt.date() != now.date():
                             dt = dt.replace(year=current_year + 1)
-                            print(f"Adjusted to next year: {dt}")
+                            current_app.logger.debug("Adjusted to next year: %s", dt)
                         else:
-                            print(f"Adjusted to current year: {dt}")
+                            current_app.logger.debug("Adjusted to current year: %s", dt)
                     
-                    print(f"Parsed date from AI: {date_str} -> {dt}")
+                    current_app.logger.debug("Parsed date from AI: %s -> %s", date_str, dt)
                 else:
                     # Use tomorrow at 9am
                     dt = datetime.now() + timedelta(days=1)
                     dt = dt.replace(hour=9, minute=0, second=0, microsecond=0)
-                    print(f"Using default tomorrow at 9am: {dt}")
+                    current_app.logger.debug("Using default tomorrow at 9am: %s", dt)
             except Exception as e:
-                print(f"Error parsing date from AI: {e}")
+                current_app.logger.error("Error parsing date from AI: %s", e)
                 # Fallback to tomorrow at 9am
                 dt = datetime.now() + timedelta(days=1)
                 dt = dt.replace(hour=9, minute=0, second=0, microsecond=0)
-                print(f"Using fallback tomorrow at 9am: {dt}")
+                current_app.logger.debug("Using fallback tomorrow at 9am: %s", dt)
             
             # Build a rich description
             description = f"Task: {task_desc}"
@@ -875,7 +885,7 @@ def add_task():
                 
             # Create the calendar event - note: no Z suffix to avoid UTC designation
             iso_date = dt.isoformat()
-            print(f"Creating event with ISO date: {iso_date}")
+            current_app.logger.debug("Creating event with ISO date: %s", iso_date)
             event = create_calendar_event(
                 user_id, 
                 title, 
@@ -896,12 +906,12 @@ def add_task():
                 "location": location
             })
         except Exception as parse_error:
-            current_app.logger.error(f"Error parsing AI response: {parse_error}")
+            current_app.logger.error("Error parsing AI response: %s", parse_error)
             current_app.logger.error(traceback.format_exc())
             return jsonify({"response": task_desc})
                 
     except Exception as e:
-        current_app.logger.error(f"Add task error: {str(e)}")
+        current_app.logger.error("Add task error: %s", str(e))
         current_app.logger.error(traceback.format_exc())
         return jsonify({"error": "Internal server error"}), 500
 
@@ -940,10 +950,11 @@ def find_free_slots(events, date_to_check, timezone="America/New_York"):
         if not event_start or not event_end:
             continue
             
-        # Convert to datetime objects
+        # Convert to datetime objects; ciso8601 handles the trailing Z
+        # without the str.replace copy fromisoformat needed
         try:
-            event_start_dt = datetime.fromisoformat(event_start.replace('Z', '+00:00'))
-            event_end_dt = datetime.fromisoformat(event_end.replace('Z', '+00:00'))
+            event_start_dt = ciso8601.parse_datetime(event_start)
+            event_end_dt = ciso8601.parse_datetime(event_end)
             
             # Convert to target timezone
             event_start_dt = event_start_dt.astimezone(tz)
@@ -959,7 +970,7 @@ def find_free_slots(events, date_to_check, timezone="America/New_York"):
                     
                 day_events.append((event_start_dt, event_end_dt, event.get('summary', 'No Title')))
         except Exception as e:
-            current_app.logger.error(f"Error parsing event date: {e}")
+            current_app.logger.error("Error parsing event date: %s", e)
             continue
     
     # Sort events by start time
@@ -1008,7 +1019,6 @@ def parse_date_with_ai(date_text, model):
         date_str = response.text.strip()
         
         # Extract just the date if there's additional text
-        import re
         date_match = re.search(r'\d{4}-\d{2}-\d{2}', date_str)
         if date_match:
             date_str = date_match.group(0)
@@ -1017,7 +1027,7 @@ def parse_date_with_ai(date_text, model):
         parsed_date = datetime.strptime(date_str, '%Y-%m-%d').date()
         return parsed_date
     except Exception as e:
-        current_app.logger.error(f"Error parsing date with AI: {e}")
+        current_app.logger.error("Error parsing date with AI: %s", e)
         # Return today's date as fallback
         return datetime.now().date()
 
@@ -1030,9 +1040,6 @@ def check_availability_command(command_content, user_id):
         })
     
     try:
-        # Initialize the model for date parsing
-        model = GenerativeModel(os.environ.get('GEMINI_MODEL', 'gemini-1.5-flash'))
-        
         # Parse the date using AI
         date_to_check = parse_date_with_ai(command_content, model)
         
@@ -1080,7 +1087,7 @@ def check_availability_command(command_content, user_id):
             "free_slots": len(free_slots) > 0
         })
     except Exception as e:
-        current_app.logger.error(f"Error checking availability: {e}")
+        current_app.logger.error("Error checking availability: %s", e)
         current_app.logger.error(traceback.format_exc())
         return jsonify({
             "response": f"I encountered an error checking your availability: {str(e)}",
@@ -1096,9 +1103,6 @@ def suggest_time_command(command_content, user_id):
         })
     
     try:
-        # Initialize the model
-        model = GenerativeModel(os.environ.get('GEMINI_MODEL', 'gemini-1.5-flash'))
-        
         # Extract event details and target date
         prompt = f"""
         Extract event information from this request: "{command_content}"
@@ -1121,13 +1125,7 @@ def suggest_time_command(command_content, user_id):
         response = model.generate_content(prompt)
         response_text = response.text.strip()
         
-        # Extract JSON from response if needed
-        if "```json" in response_text:
-            json_str = response_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in response_text:
-            json_str = response_text.split("```")[1].strip()
-        else:
-            json_str = response_text
+        json_str = extract_json_payload(response_text)
             
         event_data = json.loads(json_str)
         
@@ -1222,7 +1220,7 @@ def suggest_time_command(command_content, user_id):
         })
         
     except Exception as e:
-        current_app.logger.error(f"Error suggesting time: {e}")
+        current_app.logger.error("Error suggesting time: %s", e)
         current_app.logger.error(traceback.format_exc())
         return jsonify({
             "response": f"I encountered an error suggesting a time for your event: {str(e)}",
@@ -47,6 +47,10 @@ AVAILABLE_CATEGORIES = [
     "Bookings"
 ]
 
+# O(1) membership for validation; the list above keeps its curated order for
+# the preferences page
+AVAILABLE_CATEGORIES_SET = frozenset(AVAILABLE_CATEGORIES)
+
 @preferences_bp.route('/preferences')
 @require_auth
 def preferences_page():
@@ -75,11 +79,12 @@ def update_preferences():
         interests = data.get('interests', [])
         custom_interests = data.get('custom_interests', [])
         
+        valid = AVAILABLE_CATEGORIES_SET | set(custom_interests)
         for interest in interests:
-            if interest not in AVAILABLE_CATEGORIES and interest not in custom_interests:
+            if interest not in valid:
                 return jsonify({"error": f"Invalid interest: {interest}"}), 400
                 
-        all_interests = list(set(interests + custom_interests))
+        all_interests = list({*interests, *custom_interests})
         
         preferences = {
             "interests": all_interests,
@@ -1,109 +1,300 @@
 import os
-import json
-import jwt
+import orjson
 import base64
+import time
+import random
+import secrets
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from functools import wraps
-from flask import session, jsonify, request, redirect, url_for
+from functools import lru_cache, wraps
+from flask import session, jsonify, request, redirect, g, has_request_context
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 import msal
 
-from config import CLIENT_ID, CLIENT_SECRET, AUTHORITY, SCOPES, TOKENS_DIR, KEY_FILE, REDIRECT_PATH
+from config import CLIENT_ID, CLIENT_SECRET, AUTHORITY, SCOPES, TOKENS_DIR, KEY_FILE
 
 Path(TOKENS_DIR).mkdir(exist_ok=True)
-if not os.path.exists(KEY_FILE):
+try:
+    with open(KEY_FILE, 'rb') as f:
+        key = f.read()
+except FileNotFoundError:
     key = Fernet.generate_key()
     with open(KEY_FILE, 'wb') as f:
         f.write(key)
-else:
-    with open(KEY_FILE, 'rb') as f:
-        key = f.read()
 
+# Legacy cipher: token files written before the AES-GCM switch
 cipher = Fernet(key)
+# AES-GCM does authenticated encryption in one pass where Fernet runs
+# HMAC-SHA256 + AES-CBC + base64; the Fernet key material decodes to the
+# 32 raw bytes AESGCM wants, so both ciphers share the same key file
+aesgcm = AESGCM(base64.urlsafe_b64decode(key))
+
+_msal_app = None
 
 def get_msal_app():
-    return msal.ConfidentialClientApplication(
-        CLIENT_ID,
-        authority=AUTHORITY,
-        client_credential=CLIENT_SECRET,
-    )
+    """Return the process-wide MSAL app.
+
+    Building a ConfidentialClientApplication re-fetches and re-parses
+    authority metadata; reusing one instance also keeps MSAL's in-memory
+    token cache (and its accounts) alive across requests."""
+    global _msal_app
+    if _msal_app is None:
+        _msal_app = msal.ConfidentialClientApplication(
+            CLIENT_ID,
+            authority=AUTHORITY,
+            client_credential=CLIENT_SECRET,
+        )
+    return _msal_app
+
+def warm_msal_authority():
+    """Trigger MSAL's authority metadata discovery ahead of the first login.
+
+    The first get_authorization_request_url on a fresh app instance fetches
+    and parses the OpenID configuration; doing a throwaway call at startup
+    moves that round trip off the first user's /login."""
+    try:
+        from config import REDIRECT_URI
+        get_msal_app().get_authorization_request_url(
+            SCOPES,
+            redirect_uri=REDIRECT_URI,
+            state="warmup"
+        )
+    except Exception:
+        pass
 
 def get_auth_url():
     app = get_msal_app()
     from config import REDIRECT_URI
+    state = secrets.token_urlsafe(16)
+    if has_request_context():
+        # Remember the state so the callback can verify the round trip
+        session['oauth_state'] = state
     auth_url = app.get_authorization_request_url(
         SCOPES,
         redirect_uri=REDIRECT_URI,
-        state=str(hash(f"state-{REDIRECT_URI}-{__import__('time').time()}")),
+        state=state,
         prompt="consent"
     )
     return auth_url
 
+# Access tokens are valid for about an hour, but every authenticated request
+# was re-reading, re-decrypting, and re-parsing the token file. Serve from
+# this in-process cache until shortly before expiry instead.
+_token_cache = {}
+_token_cache_lock = threading.RLock()
+TOKEN_CACHE_SLACK = 60
+TOKEN_CACHE_MAX_USERS = 1024
+
+def _cache_token(user_id, result):
+    # Jitter the effective expiry so tokens acquired in the same login burst
+    # don't all come due at once and stampede the refresh endpoint; the real
+    # token stays valid, we just refresh a little early.
+    expires_on = time.time() + int(result.get('expires_in', 3600)) - random.randint(0, 600)
+    with _token_cache_lock:
+        if len(_token_cache) >= TOKEN_CACHE_MAX_USERS:
+            _token_cache.pop(next(iter(_token_cache)), None)
+        _token_cache[user_id] = (result['access_token'], expires_on)
+
+def clear_cached_token(user_id):
+    with _token_cache_lock:
+        _token_cache.pop(user_id, None)
+
+# Decrypted token blobs keyed by file mtime: the file rarely changes, so
+# repeat loads skip the read + AEAD decrypt + parse and just stat the file.
+_credential_cache = {}
+
+@lru_cache(maxsize=1024)
+def _token_path(user_id):
+    return os.path.join(TOKENS_DIR, f"{user_id}.json")
+
 def save_credentials(user_id, token_response):
-    token_path = os.path.join(TOKENS_DIR, f"{user_id}.json")
-    token_json = json.dumps(token_response)
-    encrypted_token = cipher.encrypt(token_json.encode())
+    token_path = _token_path(user_id)
+    _credential_cache.pop(user_id, None)
+    _failed_lookups.pop(user_id, None)
+    # Store the absolute expiry once at save time so readers compare a single
+    # number instead of re-deriving it from expires_in on every load
+    if 'expires_on' not in token_response and 'expires_in' in token_response:
+        token_response['expires_on'] = int(time.time()) + int(token_response['expires_in'])
+    nonce = os.urandom(12)
+    encrypted_token = nonce + aesgcm.encrypt(nonce, orjson.dumps(token_response), None)
     with open(token_path, 'wb') as f:
         f.write(encrypted_token)
+    clear_cached_token(user_id)
 
 def load_credentials(user_id):
-    token_path = os.path.join(TOKENS_DIR, f"{user_id}.json")
-    if not os.path.exists(token_path):
-        return None
+    token_path = _token_path(user_id)
     try:
+        mtime_ns = os.stat(token_path).st_mtime_ns
+        cached = _credential_cache.get(user_id)
+        if cached and cached[0] == mtime_ns:
+            return dict(cached[1])
         with open(token_path, 'rb') as f:
             encrypted_token = f.read()
-        decrypted_token = cipher.decrypt(encrypted_token).decode()
-        token_response = json.loads(decrypted_token)
-        return token_response
+        try:
+            decrypted_token = aesgcm.decrypt(encrypted_token[:12], encrypted_token[12:], None)
+        except Exception:
+            # Token file predates the AES-GCM switch
+            decrypted_token = cipher.decrypt(encrypted_token)
+        token_response = orjson.loads(decrypted_token)
+        _credential_cache[user_id] = (mtime_ns, token_response)
+        return dict(token_response)
     except Exception as e:
         return None
 
-def get_token_from_cache(user_id):
-    token_response = load_credentials(user_id)
-    if not token_response:
-        return None
-    if 'error' in token_response:
+# Serialize refreshes per user: concurrent AJAX calls with an expired token
+# would otherwise race to acquire_token_by_refresh_token and the loser could
+# clobber the winner's newer token in save_credentials.
+_user_refresh_locks = defaultdict(threading.Lock)
+
+# Negative cache: once a user's refresh fails (revoked grant, deleted token
+# file), remember it briefly so every request does not replay the full
+# load + MSAL + refresh attempt during the outage. A fresh login clears it
+# through save_credentials.
+FAILED_LOOKUP_TTL = 300
+_failed_lookups = {}
+
+def get_token_from_cache(user_id, min_validity=TOKEN_CACHE_SLACK):
+    """Return a usable access token for the user, refreshing if needed.
+
+    min_validity is how much remaining lifetime a cached or on-disk token
+    must have to be served as-is. Requests use the default slack; the
+    proactive refresh paths pass TOKEN_REFRESH_WINDOW so a token inside
+    the early-refresh window actually goes through MSAL instead of being
+    re-read from disk with its old expiry."""
+    if _failed_lookups.get(user_id, 0) > time.time():
         return None
-    app = get_msal_app()
-    accounts = app.get_accounts()
-    if accounts:
-        for account in accounts:
-            result = app.acquire_token_silent(SCOPES, account=account)
+    with _token_cache_lock:
+        cached = _token_cache.get(user_id)
+        if cached and cached[1] - time.time() > min_validity:
+            if cached[1] - time.time() < TOKEN_REFRESH_WINDOW and not _user_refresh_locks[user_id].locked():
+                # Still valid but close to expiry: serve this request from
+                # cache and refresh off-thread so the next one starts fresh
+                _refresh_executor.submit(_background_refresh, user_id)
+            return cached[0]
+    with _user_refresh_locks[user_id]:
+        # Double-checked: another request may have refreshed while we waited
+        with _token_cache_lock:
+            cached = _token_cache.get(user_id)
+            if cached and cached[1] - time.time() > min_validity:
+                return cached[0]
+        token_response = load_credentials(user_id)
+        if not token_response:
+            return None
+        if 'error' in token_response:
+            return None
+        # After a restart the on-disk token is often still valid; the stored
+        # absolute expiry lets us reuse it without an MSAL round trip
+        expires_on = token_response.get('expires_on', 0)
+        if 'access_token' in token_response and expires_on - time.time() > min_validity:
+            with _token_cache_lock:
+                _token_cache[user_id] = (token_response['access_token'], expires_on)
+            return token_response['access_token']
+        app = get_msal_app()
+        accounts = app.get_accounts()
+        if len(accounts) == 1:
+            results = [app.acquire_token_silent(SCOPES, account=accounts[0])]
+        elif accounts:
+            # Multi-account users would otherwise serialize one silent
+            # acquisition (and potentially one AAD round trip) per account
+            with ThreadPoolExecutor(max_workers=min(4, len(accounts))) as executor:
+                results = list(executor.map(
+                    lambda account: app.acquire_token_silent(SCOPES, account=account),
+                    accounts
+                ))
+        else:
+            results = []
+        for result in results:
             if result and "access_token" in result:
                 save_credentials(user_id, result)
+                _cache_token(user_id, result)
                 return result["access_token"]
-    if "refresh_token" in token_response:
-        try:
-            result = app.acquire_token_by_refresh_token(
-                token_response["refresh_token"], 
-                scopes=SCOPES
-            )
-            if result and "access_token" in result:
-                save_credentials(user_id, result)
-                return result["access_token"]
-        except Exception as e:
-            pass
-    return None
+        if "refresh_token" in token_response:
+            try:
+                result = app.acquire_token_by_refresh_token(
+                    token_response["refresh_token"], 
+                    scopes=SCOPES
+                )
+                if result and "access_token" in result:
+                    save_credentials(user_id, result)
+                    _cache_token(user_id, result)
+                    return result["access_token"]
+            except Exception as e:
+                pass
+        with _token_cache_lock:
+            cached = _token_cache.get(user_id)
+            if cached and cached[1] - time.time() > TOKEN_CACHE_SLACK:
+                # An early refresh failed but the current token is still
+                # good: keep serving it instead of negative-caching the user
+                return cached[0]
+        _failed_lookups[user_id] = time.time() + FAILED_LOOKUP_TTL
+        return None
+
+TOKEN_REFRESH_WINDOW = 300
+_refresh_executor = ThreadPoolExecutor(max_workers=2)
+
+def _background_refresh(user_id):
+    try:
+        get_token_from_cache(user_id, min_validity=TOKEN_REFRESH_WINDOW)
+    except Exception:
+        pass
+
+def refresh_expiring_tokens():
+    """Proactively refresh cached tokens nearing expiry.
+
+    Runs from the background scheduler so the MSAL refresh round-trip
+    happens off the request path; get_token_from_cache keeps its inline
+    refresh as a fallback for tokens this sweep misses."""
+    now = time.time()
+    with _token_cache_lock:
+        expiring = [user_id for user_id, (_, expires_on) in _token_cache.items()
+                    if expires_on - now < TOKEN_REFRESH_WINDOW]
+    for user_id in expiring:
+        get_token_from_cache(user_id, min_validity=TOKEN_REFRESH_WINDOW)
+
+def current_access_token(user_id):
+    """Return the access token resolved earlier in this request, if any.
+
+    require_auth stores the token on flask.g, so handlers and helpers can
+    reuse it instead of a second cache lookup; outside a request context
+    (the scheduler) this falls back to the normal lookup."""
+    if has_request_context():
+        token = g.get('access_token')
+        if token:
+            return token
+    return get_token_from_cache(user_id)
+
+def _wants_json():
+    # request.is_json is a cached property, so the Content-Type parse
+    # happens at most once per request
+    return request.is_json or request.headers.get('X-Requested-With') == 'XMLHttpRequest'
 
 def require_auth(view):
     @wraps(view)
     def wrapper(*args, **kwargs):
+        if request.method == 'OPTIONS':
+            # CORS preflights carry no credentials; answering before the
+            # token lookup skips a disk read + decrypt per preflight, and
+            # Max-Age lets the browser cache the answer for a day
+            response = view(*args, **kwargs)
+            if hasattr(response, 'headers'):
+                response.headers['Access-Control-Max-Age'] = '86400'
+            return response
         if 'user_id' not in session:
-            if request and (
-                request.headers.get('X-Requested-With') == 'XMLHttpRequest' or 
-                request.headers.get('Content-Type') == 'application/json'
-            ):
+            if _wants_json():
                 return jsonify({"error": "Authentication required", "redirect": "/login"}), 401
             return redirect('/login')
         user_id = session['user_id']
         token = get_token_from_cache(user_id)
-        if not token:
+        if token:
+            # Stash the resolved token for the rest of this request so
+            # handlers don't re-run the cache lookup
+            g.access_token = token
+        else:
             session.clear()
-            if request and (
-                request.headers.get('X-Requested-With') == 'XMLHttpRequest' or 
-                request.headers.get('Content-Type') == 'application/json'
-            ):
+            if _wants_json():
                 return jsonify({"error": "Session expired", "redirect": "/login"}), 401
             return redirect('/login')
         return view(*args, **kwargs)
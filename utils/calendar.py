@@ -1,42 +1,59 @@
-import json
-import requests
-from datetime import datetime, timedelta
-import pytz
+import os
+import orjson
+from datetime import datetime, timedelta, timezone
 from tzlocal import get_localzone
-from utils.auth import get_token_from_cache, get_msal_app
-from config import SCOPES
+from utils.auth import current_access_token
+from utils.http import graph_session
+from config import TOKENS_DIR
+
+GRAPH_BASE = "https://graph.microsoft.com/v1.0"
+
+# The server's zone never changes while the process runs, and tzlocal
+# re-reads /etc/localtime on every get_localzone() call - resolve it once.
+try:
+    _LOCAL_TZ_STR = str(get_localzone())
+except Exception:
+    _LOCAL_TZ_STR = 'Asia/Kolkata'
 
 def get_fresh_token_for_calendar(user_id):
-    cached_token = get_token_from_cache(user_id)
-    if not cached_token:
-        return None
-    app = get_msal_app()
-    accounts = app.get_accounts()
-    if accounts:
-        for account in accounts:
-            result = app.acquire_token_silent(SCOPES, account=account)
-            if result and 'access_token' in result:
-                return result['access_token']
-    return cached_token
+    # current_access_token already serves the request-scoped token or the
+    # expiry-tracked cache in utils.auth, which refreshes when needed -
+    # re-walking MSAL accounts here just re-parsed the token cache on
+    # every calendar call for the same answer
+    return current_access_token(user_id)
+
+# Header dicts keyed by token: the seven-entry dict and the Bearer f-string
+# were rebuilt on every Graph call even though tokens rotate about hourly.
+_graph_headers_cache = {}
+
+def _graph_headers(access_token):
+    headers = _graph_headers_cache.get(access_token)
+    if headers is None:
+        if len(_graph_headers_cache) > 64:
+            _graph_headers_cache.clear()
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'User-Agent': 'Mozilla/5.0 (compatible; RUNDOWN-App/1.0)',
+            'X-AnchorMailbox': 'UPN',
+            'Prefer': 'outlook.timezone="UTC"',
+            'ConsistencyLevel': 'eventual'
+        }
+        _graph_headers_cache[access_token] = headers
+    return headers
 
 def make_graph_request(access_token, url, method='GET', data=None, params=None):
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'User-Agent': 'Mozilla/5.0 (compatible; RUNDOWN-App/1.0)',
-        'X-AnchorMailbox': 'UPN',
-        'Prefer': 'outlook.timezone="UTC"',
-        'ConsistencyLevel': 'eventual'
-    }
+    headers = _graph_headers(access_token)
     try:
-        import requests
         if method.upper() == 'GET':
-            response = requests.get(url, headers=headers, params=params, timeout=30)
+            response = graph_session.get(url, headers=headers, params=params, timeout=30)
         elif method.upper() == 'POST':
-            response = requests.post(url, headers=headers, json=data, timeout=30)
+            # Content-Type is already set above; orjson skips requests'
+            # internal json.dumps on every POST
+            response = graph_session.post(url, headers=headers, data=orjson.dumps(data), timeout=30)
         elif method.upper() == 'DELETE':
-            response = requests.delete(url, headers=headers, timeout=30)
+            response = graph_session.delete(url, headers=headers, timeout=30)
         else:
             raise ValueError(f"Unsupported HTTP method: {method}")
         if response.status_code >= 400:
@@ -48,19 +65,12 @@ def make_graph_request(access_token, url, method='GET', data=None, params=None):
 
 def handle_graph_api_error(response):
     try:
-        error_data = response.json()
+        error_data = orjson.loads(response.content)
     except Exception as json_error:
         pass
 
-def create_calendar_event(user_id, subject, sender, date_str, iso_date, end_date=None, description=None, set_reminder=False):
-    access_token = get_fresh_token_for_calendar(user_id)
-    if not access_token:
-        raise Exception("No valid access token available")
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
-    timezone_str = 'Asia/Kolkata'
+def _build_event_body(subject, sender, date_str, iso_date, end_date=None, description=None):
+    timezone_str = _LOCAL_TZ_STR
     if iso_date.endswith('Z'):
         iso_date = iso_date[:-1]
     if not end_date:
@@ -93,21 +103,87 @@ def create_calendar_event(user_id, subject, sender, date_str, iso_date, end_date
         'isReminderOn': True,
         'reminderMinutesBeforeStart': 30
     }
+    return event_body
+
+GRAPH_BATCH_LIMIT = 20
+
+def _graph_batch(access_token, batch_requests):
+    """POST sub-requests to Graph's /\$batch endpoint, 20 per call.
+
+    Returns the flattened list of sub-responses; each carries the 'id' of
+    the sub-request it answers."""
+    responses = []
+    for chunk_start in range(0, len(batch_requests), GRAPH_BATCH_LIMIT):
+        chunk = batch_requests[chunk_start:chunk_start + GRAPH_BATCH_LIMIT]
+        response = make_graph_request(
+            access_token,
+            f"{GRAPH_BASE}/$batch",
+            method='POST',
+            data={'requests': chunk}
+        )
+        if response is not None:
+            responses.extend(orjson.loads(response.content).get('responses', []))
+    return responses
+
+def create_calendar_events(user_id, event_specs):
+    """Create several calendar events in one round trip per 20.
+
+    Each spec holds the create_calendar_event keyword arguments; returns the
+    Graph bodies of the events that were created."""
+    access_token = get_fresh_token_for_calendar(user_id)
+    if not access_token:
+        raise Exception("No valid access token available")
+    batch_requests = [
+        {
+            'id': str(i),
+            'method': 'POST',
+            'url': '/me/events',
+            'headers': {'Content-Type': 'application/json'},
+            'body': _build_event_body(**spec)
+        }
+        for i, spec in enumerate(event_specs)
+    ]
+    created = []
+    for sub_response in _graph_batch(access_token, batch_requests):
+        if sub_response.get('status') == 201:
+            created.append(sub_response.get('body'))
+    return created
+
+def delete_calendar_events(user_id, event_ids):
+    """Delete several calendar events in one round trip per 20.
+
+    No existence probe: a DELETE on a missing event just reports 404 in its
+    sub-response, which maps to 'not_found' below."""
+    access_token = get_fresh_token_for_calendar(user_id)
+    if not access_token:
+        raise Exception("No valid access token available")
+    batch_requests = [
+        {'id': str(i), 'method': 'DELETE', 'url': f'/me/events/{event_id}'}
+        for i, event_id in enumerate(event_ids)
+    ]
+    results = {}
+    for sub_response in _graph_batch(access_token, batch_requests):
+        event_id = event_ids[int(sub_response['id'])]
+        status = sub_response.get('status')
+        if status == 204:
+            results[event_id] = {"status": "deleted", "message": "Event deleted successfully"}
+        elif status == 404:
+            results[event_id] = {"status": "not_found", "message": "Event already deleted"}
+        else:
+            results[event_id] = {"status": "error", "message": f"Delete failed with status {status}"}
+    return results
+
+def create_calendar_event(user_id, subject, sender, date_str, iso_date, end_date=None, description=None, set_reminder=False):
+    access_token = get_fresh_token_for_calendar(user_id)
+    if not access_token:
+        raise Exception("No valid access token available")
+    event_body = _build_event_body(subject, sender, date_str, iso_date, end_date, description)
     try:
-        url = "https://graph.microsoft.com/v1.0/me/events"
+        url = f"{GRAPH_BASE}/me/events"
         response = make_graph_request(access_token, url, method='POST', data=event_body)
         if response and response.status_code == 201:
-            event = response.json()
-            return event
-        else:
-            beta_url = "https://graph.microsoft.com/beta/me/events"
-            beta_response = make_graph_request(access_token, beta_url, method='POST', data=event_body)
-            if beta_response and beta_response.status_code == 201:
-                event = beta_response.json()
-                return event
-            else:
-                error_msg = f"Failed to create calendar event on both v1.0 and beta endpoints"
-                raise Exception(error_msg)
+            return orjson.loads(response.content)
+        raise Exception("Failed to create calendar event")
     except Exception as e:
         raise
 
@@ -116,74 +192,127 @@ def delete_calendar_event(user_id, event_id):
     if not access_token:
         raise Exception("No valid access token available")
     try:
-        url = f"https://graph.microsoft.com/v1.0/me/events/{event_id}"
-        response = make_graph_request(access_token, url, method='GET')
-        if response is None:
-            raise Exception("Failed to verify event existence")
-        elif response.status_code == 404:
-            return {"status": "not_found", "message": "Event already deleted"}
-        elif response.status_code == 200:
-            event = response.json()
-        else:
-            raise Exception(f"Error checking event: {response.status_code}")
-        delete_response = make_graph_request(access_token, url, method='DELETE')
-        if delete_response and delete_response.status_code == 204:
+        # No existence probe: DELETE already reports 404 for a missing
+        # event, so the extra GET just doubled the round trips
+        url = f"{GRAPH_BASE}/me/events/{event_id}"
+        delete_response = graph_session.delete(url, headers=_graph_headers(access_token), timeout=30)
+        if delete_response.status_code == 204:
             return {"status": "deleted", "message": "Event deleted successfully"}
+        elif delete_response.status_code == 404:
+            return {"status": "not_found", "message": "Event already deleted"}
         else:
-            raise Exception(f"Failed to delete event")
+            raise Exception(f"Failed to delete event: {delete_response.status_code}")
     except Exception as e:
         raise
 
+# Delta sync: instead of re-downloading the upcoming-events list on every
+# fetch, keep a per-user snapshot plus Graph's deltaLink on disk and ask the
+# server only for what changed since last time.
+CALENDAR_SYNC_WINDOW_DAYS = 30
+CALENDAR_EVENTS_LIMIT = 10
+# Re-anchor the window when fewer than this many days of it remain ahead of
+# now: the deltaLink only tracks the calendarView range fixed at the first
+# sync, so events beyond its end never appear until a full re-sync.
+CALENDAR_RESYNC_MARGIN_DAYS = 7
+
+def _delta_state_path(user_id):
+    return os.path.join(TOKENS_DIR, f"{user_id}_calendar_delta.json")
+
+def _load_delta_state(user_id):
+    try:
+        with open(_delta_state_path(user_id), 'rb') as f:
+            return orjson.loads(f.read())
+    except Exception:
+        return None
+
+def _save_delta_state(user_id, state):
+    try:
+        with open(_delta_state_path(user_id), 'wb') as f:
+            f.write(orjson.dumps(state))
+    except Exception:
+        pass
+
+def _format_event(event):
+    return {
+        "id": event.get("id", ""),
+        "summary": event.get("subject", "No Title"),
+        "description": event.get("bodyPreview", ""),
+        "start": event.get("start", {}),
+        "end": event.get("end", {}),
+        "webLink": event.get("webLink", "")
+    }
+
+def _run_delta_pages(access_token, url):
+    """Follow nextLinks until Graph hands back a deltaLink.
+
+    Returns (changes, delta_link); (None, None) when any page fails,
+    including a 410 Gone for an expired delta token."""
+    changes = []
+    delta_link = None
+    while url:
+        response = make_graph_request(access_token, url, method='GET')
+        if response is None or response.status_code != 200:
+            return None, None
+        payload = orjson.loads(response.content)
+        changes.extend(payload.get('value', []))
+        delta_link = payload.get('@odata.deltaLink')
+        url = payload.get('@odata.nextLink')
+    return changes, delta_link
+
+def _merge_delta_changes(state, changes):
+    events = state.setdefault('events', {})
+    for change in changes:
+        event_id = change.get('id')
+        if not event_id:
+            continue
+        if '@removed' in change:
+            events.pop(event_id, None)
+        else:
+            events[event_id] = _format_event(change)
+
+def _upcoming_from_state(state):
+    # Graph returns UTC datetimes (Prefer: outlook.timezone="UTC"), so the
+    # ISO strings compare and sort correctly without parsing
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    events = [event for event in state.get('events', {}).values()
+              if event.get('start', {}).get('dateTime', '') >= now]
+    events.sort(key=lambda event: event.get('start', {}).get('dateTime', ''))
+    return events[:CALENDAR_EVENTS_LIMIT]
+
 def fetch_calendar_events(user_id):
     access_token = get_fresh_token_for_calendar(user_id)
     if not access_token:
         raise Exception("No valid access token available - user needs to re-authenticate")
     try:
-        now = datetime.utcnow().isoformat() + 'Z'
-        simple_endpoints = [
-            "https://graph.microsoft.com/v1.0/me/events?$top=5",
-            "https://graph.microsoft.com/beta/me/events?$top=5",
-            "https://graph.microsoft.com/v1.0/me/calendar/events?$top=5"
-        ]
-        for endpoint in simple_endpoints:
-            response = make_graph_request(access_token, endpoint, method='GET')
-            if response and response.status_code == 200:
-                events_data = response.json().get('value', [])
-                filtered_endpoint = endpoint.replace('?$top=5', '')
-                params = {
-                    '$filter': f"start/dateTime ge '{now}'",
-                    '$top': 10,
-                    '$orderby': 'start/dateTime',
-                    '$select': 'id,subject,bodyPreview,start,end,webLink'
-                }
-                filtered_response = make_graph_request(access_token, filtered_endpoint, method='GET', params=params)
-                if filtered_response and filtered_response.status_code == 200:
-                    filtered_events = filtered_response.json().get('value', [])
-                    formatted_events = []
-                    for event in filtered_events:
-                        formatted_event = {
-                            "id": event.get("id", ""),
-                            "summary": event.get("subject", "No Title"),
-                            "description": event.get("bodyPreview", ""),
-                            "start": event.get("start", {}),
-                            "end": event.get("end", {}),
-                            "webLink": event.get("webLink", "")
-                        }
-                        formatted_events.append(formatted_event)
-                    return formatted_events
-                else:
-                    formatted_events = []
-                    for event in events_data:
-                        formatted_event = {
-                            "id": event.get("id", ""),
-                            "summary": event.get("subject", "No Title"),
-                            "description": event.get("bodyPreview", ""),
-                            "start": event.get("start", {}),
-                            "end": event.get("end", {}),
-                            "webLink": event.get("webLink", "")
-                        }
-                        formatted_events.append(formatted_event)
-                    return formatted_events
-        return []
+        now = datetime.now(timezone.utc)
+        state = _load_delta_state(user_id)
+        # The link only tracks the window anchored at the first sync; once
+        # that window's end gets close, events past it would never show up,
+        # so drop the link and re-anchor with a fresh full sync.
+        horizon = (now + timedelta(days=CALENDAR_RESYNC_MARGIN_DAYS)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        if state and state.get('deltaLink') and state.get('window_end', '') > horizon:
+            changes, delta_link = _run_delta_pages(access_token, state['deltaLink'])
+            if changes is not None:
+                _merge_delta_changes(state, changes)
+                if delta_link:
+                    state['deltaLink'] = delta_link
+                _save_delta_state(user_id, state)
+                return _upcoming_from_state(state)
+        # First sync, an aged-out window, or an expired delta token: pull
+        # a fresh window anchored at now
+        start = now.strftime('%Y-%m-%dT%H:%M:%SZ')
+        end = (now + timedelta(days=CALENDAR_SYNC_WINDOW_DAYS)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        url = (f"{GRAPH_BASE}/me/calendarView/delta"
+               f"?startDateTime={start}&endDateTime={end}"
+               f"&$select=id,subject,bodyPreview,start,end,webLink")
+        changes, delta_link = _run_delta_pages(access_token, url)
+        if changes is None:
+            return []
+        state = {'events': {}, 'window_end': end}
+        _merge_delta_changes(state, changes)
+        if delta_link:
+            state['deltaLink'] = delta_link
+            _save_delta_state(user_id, state)
+        return _upcoming_from_state(state)
     except Exception as e:
         return []
@@ -0,0 +1,38 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# One pooled session per process, shared by every Graph caller. Keep-alive
+# connections turn the per-call TLS handshake into a one-time cost, and the
+# retry policy absorbs transient Graph throttling/5xx responses.
+# Retry honors Graph's Retry-After header on 429/503 by default; listing the
+# write methods explicitly matters because urllib3 only status-retries
+# idempotent verbs otherwise.
+
+class _GraphRetry(Retry):
+    # 429 and 503 mean the request was rejected before it ran, so replaying
+    # a POST cannot double-apply. A 502/504 can arrive after Graph already
+    # executed it, and a replayed POST /me/events (or $batch of creates)
+    # would silently duplicate events - so POST only status-retries the
+    # rejected-before-running codes; other verbs keep the full list.
+    _POST_SAFE_STATUSES = frozenset({429, 503})
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method and method.upper() == 'POST' and status_code not in self._POST_SAFE_STATUSES:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=_GraphRetry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset({'GET', 'POST', 'PATCH', 'DELETE', 'PUT', 'HEAD', 'OPTIONS'}),
+        respect_retry_after_header=True
+    )
+)
+
+graph_session = requests.Session()
+graph_session.mount('https://', _adapter)
@@ -1,8 +1,12 @@
 from flask import session
 import os
-import json
+import orjson
 from config import TOKENS_DIR
 
+# Preferences are read on every suggestion request and scheduler tick but
+# change rarely; cache the parsed dict keyed by the file's mtime.
+_preferences_cache = {}
+
 class UserPreferences:
     """Manages user preferences for email filtering and task suggestions."""
     
@@ -15,12 +19,14 @@ class UserPreferences:
     def save_preferences(user_id, preferences):
         """Save user preferences to a file."""
         preferences_path = UserPreferences.get_preferences_path(user_id)
-        with open(preferences_path, 'w') as f:
-            json.dump(preferences, f)
+        with open(preferences_path, 'wb') as f:
+            f.write(orjson.dumps(preferences))
+        _preferences_cache[user_id] = (os.path.getmtime(preferences_path), preferences)
     
     @staticmethod
     def load_preferences(user_id):
-        """Load user preferences from a file."""
+        """Load user preferences from a file, reusing the cached copy while
+        the file is unchanged."""
         preferences_path = UserPreferences.get_preferences_path(user_id)
         if not os.path.exists(preferences_path):
             # Default preferences
@@ -28,8 +34,14 @@ class UserPreferences:
                 "interests": [],
                 "enabled": True
             }
-        with open(preferences_path, 'r') as f:
-            return json.load(f)
+        mtime = os.path.getmtime(preferences_path)
+        cached = _preferences_cache.get(user_id)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(preferences_path, 'rb') as f:
+            preferences = orjson.loads(f.read())
+        _preferences_cache[user_id] = (mtime, preferences)
+        return preferences
     
     @staticmethod
     def update_preferences(user_id, new_preferences):
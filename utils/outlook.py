@@ -1,25 +1,56 @@
 import json
+import orjson
+import time
+import re
 import requests
 import os
-from datetime import datetime, timedelta
-from utils.auth import get_token_from_cache
+import gzip
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from utils.auth import current_access_token
+from utils.http import graph_session as http_session
+
+GRAPH_BASE = "https://graph.microsoft.com/v1.0"
+GRAPH_BETA = "https://graph.microsoft.com/beta"
+EMAIL_SELECT = 'id,subject,from,receivedDateTime,body,categories'
+
+# Archive directory, resolved once instead of the three-deep os.path walk
+# every save/load/list call repeated
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'emails')
+
+# Header dicts keyed by token, same trick as the calendar module: the
+# Bearer f-string and six-entry dict otherwise get rebuilt on every call,
+# which adds up across MIME batches.
+_graph_headers_cache = {}
+
+def _graph_headers(access_token):
+    headers = _graph_headers_cache.get(access_token)
+    if headers is None:
+        if len(_graph_headers_cache) > 64:
+            _graph_headers_cache.clear()
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'User-Agent': 'Mozilla/5.0 (compatible; RUNDOWN-App/1.0)',
+            'X-AnchorMailbox': 'UPN', 
+            'Prefer': 'outlook.timezone="UTC"'
+        }
+        _graph_headers_cache[access_token] = headers
+    return headers
 
 def make_graph_request(access_token, url, method='GET', data=None, params=None):
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'User-Agent': 'Mozilla/5.0 (compatible; RUNDOWN-App/1.0)',
-        'X-AnchorMailbox': 'UPN', 
-        'Prefer': 'outlook.timezone="UTC"'
-    }
+    headers = _graph_headers(access_token)
     try:
         if method.upper() == 'GET':
-            response = requests.get(url, headers=headers, params=params, timeout=30)
+            response = http_session.get(url, headers=headers, params=params, timeout=30)
         elif method.upper() == 'POST':
-            response = requests.post(url, headers=headers, json=data, timeout=30)
+            # Content-Type is already set above; orjson skips requests'
+            # internal json.dumps, which matters for $batch payloads
+            response = http_session.post(url, headers=headers, data=orjson.dumps(data), timeout=30)
         elif method.upper() == 'PATCH':
-            response = requests.patch(url, headers=headers, json=data, timeout=30)
+            response = http_session.patch(url, headers=headers, data=orjson.dumps(data), timeout=30)
         else:
             raise ValueError(f"Unsupported HTTP method: {method}")
         if response.status_code >= 400:
@@ -34,26 +65,46 @@ def handle_outlook_api_error(response):
     except:
         pass
 
+# Master categories barely ever change, yet every scheduler tick re-fetched
+# the whole list just to confirm ours exists. Remember the names per token
+# for a few minutes instead.
+CATEGORY_CACHE_TTL = 300
+_category_cache = {}
+
 def create_outlook_category(access_token, category_name):
-    url = "https://graph.microsoft.com/v1.0/me/outlook/masterCategories"
+    cached = _category_cache.get(access_token)
+    if cached and time.time() - cached[0] < CATEGORY_CACHE_TTL:
+        if category_name in cached[1]:
+            return category_name
+    elif cached:
+        # Expired entries belong to rotated tokens that are never looked up
+        # again; drop them so the dict doesn't grow one per user per hour
+        _category_cache.pop(access_token, None)
+    url = f"{GRAPH_BASE}/me/outlook/masterCategories"
     response = make_graph_request(access_token, url, method='GET')
     if response and response.status_code == 200:
-        categories = response.json().get('value', [])
-        for category in categories:
-            if category['displayName'] == category_name:
-                return category['displayName']
+        names = {category['displayName'] for category in response.json().get('value', [])}
+        if len(_category_cache) > 64:
+            _category_cache.clear()
+        _category_cache[access_token] = (time.time(), names)
+        if category_name in names:
+            return category_name
     category_data = {
         "displayName": category_name,
         "color": "preset2"
     }
     create_response = make_graph_request(access_token, url, method='POST', data=category_data)
     if create_response and create_response.status_code == 201:
-        return create_response.json()['displayName']
+        created = create_response.json()['displayName']
+        cached = _category_cache.get(access_token)
+        if cached:
+            cached[1].add(created)
+        return created
     else:
         return None
 
 def get_email_details(access_token, email_id):
-    url = f"https://graph.microsoft.com/v1.0/me/messages/{email_id}"
+    url = f"{GRAPH_BASE}/me/messages/{email_id}"
     response = make_graph_request(access_token, url, method='GET')
     if response and response.status_code == 200:
         email_data = response.json()
@@ -70,175 +121,348 @@ def get_email_details(access_token, email_id):
         return {'error': f'Failed to fetch email: {response.status_code if response else "No response"}'}
 
 def save_emails_to_json(user_id, emails):
+    """Write the fetch as JSON Lines: a metadata header line, then one
+    email per line. Serializing per line keeps peak memory at one email's
+    worth instead of the whole batch, and lets future fetch paths append
+    as messages arrive."""
     try:
-        data_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'emails')
+        data_dir = DATA_DIR
         os.makedirs(data_dir, exist_ok=True)
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"emails_{user_id}_{timestamp}.json"
+        filename = f"emails_{user_id}_{timestamp}.jsonl.gz"
         filepath = os.path.join(data_dir, filename)
-        email_data = {
+        header = {
             'user_id': user_id,
             'fetch_timestamp': datetime.now().isoformat(),
-            'email_count': len(emails),
-            'emails': emails
+            'email_count': len(emails)
         }
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(email_data, f, indent=2, ensure_ascii=False)
+        # HTML bodies and base64 MIME compress several-fold; level 3 keeps
+        # the CPU cost small next to the disk bytes it saves
+        with gzip.open(filepath, 'wb', compresslevel=3) as f:
+            f.write(orjson.dumps(header) + b'\n')
+            for email in emails:
+                f.write(orjson.dumps(email) + b'\n')
         return filepath
     except Exception as e:
         return None
 
+def _latest_archive_path(user_id, latest=True):
+    data_dir = DATA_DIR
+    if not os.path.exists(data_dir):
+        return None
+    prefix = f"emails_{user_id}_"
+    with os.scandir(data_dir) as entries:
+        # DirEntry carries the stat from the directory read, so sorting
+        # by mtime costs no extra stat syscalls
+        user_files = [entry for entry in entries
+                      if entry.name.startswith(prefix) and entry.name.endswith(('.json', '.jsonl', '.jsonl.gz'))]
+    if not user_files:
+        return None
+    if latest:
+        user_files.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    return user_files[0].path
+
+# Archive writes are pure bookkeeping - nothing in the fetch path reads
+# the file back - so they run on this small pool instead of holding up
+# the response while the emails hit disk. Two workers is enough: writes
+# are per-user and the scheduler staggers users anyway.
+_io_pool = ThreadPoolExecutor(max_workers=2)
+atexit.register(_io_pool.shutdown, wait=True)
+
+def _open_archive(filepath):
+    # Sniff the suffix: current archives are gzipped, ones written before
+    # the switch are plain files in the same line format
+    if filepath.endswith('.gz'):
+        return gzip.open(filepath, 'rb')
+    return open(filepath, 'rb')
+
 def load_emails_from_json(user_id, latest=True):
     try:
-        data_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'emails')
-        if not os.path.exists(data_dir):
+        filepath = _latest_archive_path(user_id, latest)
+        if not filepath:
             return None
-        user_files = []
-        for filename in os.listdir(data_dir):
-            if filename.startswith(f"emails_{user_id}_") and filename.endswith('.json'):
-                filepath = os.path.join(data_dir, filename)
-                user_files.append(filepath)
-        if not user_files:
+        if filepath.endswith(('.jsonl', '.jsonl.gz')):
+            with _open_archive(filepath) as f:
+                email_data = orjson.loads(f.readline())
+                email_data['emails'] = [orjson.loads(line) for line in f if line.strip()]
+            return email_data
+        # Archives from before the JSON Lines switch
+        with open(filepath, 'rb') as f:
+            email_data = orjson.loads(f.read())
+        return email_data
+    except Exception as e:
+        return None
+
+def load_emails_meta(user_id):
+    """Return just the archive metadata (user_id, fetch_timestamp,
+    email_count) without materializing the emails.
+
+    The JSON Lines header is exactly this record, so the cheap path reads
+    one line no matter how large the archive grew; legacy single-object
+    archives still need a full parse to reach the top-level keys."""
+    try:
+        filepath = _latest_archive_path(user_id)
+        if not filepath:
             return None
-        if latest:
-            user_files.sort(key=os.path.getmtime, reverse=True)
-            filepath = user_files[0]
-        else:
-            filepath = user_files[0]
-        with open(filepath, 'r', encoding='utf-8') as f:
-            email_data = json.load(f)
+        if filepath.endswith(('.jsonl', '.jsonl.gz')):
+            with _open_archive(filepath) as f:
+                return orjson.loads(f.readline())
+        with open(filepath, 'rb') as f:
+            email_data = orjson.loads(f.read())
+        email_data.pop('emails', None)
         return email_data
     except Exception as e:
         return None
 
+# Listing results keyed by the directory's mtime: browsing the archive UI
+# hits this repeatedly, and the directory only changes when a fetch writes
+# a new file (which bumps st_mtime_ns and invalidates the entry).
+_list_cache = {}
+
 def get_stored_email_files(user_id=None):
     try:
-        data_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'emails')
-        if not os.path.exists(data_dir):
+        data_dir = DATA_DIR
+        try:
+            dir_mtime = os.stat(data_dir).st_mtime_ns
+        except FileNotFoundError:
             return []
+        cached = _list_cache.get((user_id, dir_mtime))
+        if cached is not None:
+            return cached
         files_info = []
-        for filename in os.listdir(data_dir):
-            if filename.endswith('.json'):
-                if user_id and not filename.startswith(f"emails_{user_id}_"):
+        with os.scandir(data_dir) as entries:
+            for entry in entries:
+                match = _archive_name_pattern.match(entry.name)
+                if not match:
+                    continue
+                file_user_id, date_part, time_part = match.groups()
+                if user_id and file_user_id != user_id:
                     continue
-                filepath = os.path.join(data_dir, filename)
                 try:
-                    parts = filename.replace('.json', '').split('_')
-                    if len(parts) >= 4:
-                        file_user_id = '_'.join(parts[1:-2])
-                        date_part = parts[-2]
-                        time_part = parts[-1]
-                        stat = os.stat(filepath)
-                        files_info.append({
-                            'filename': filename,
-                            'filepath': filepath,
-                            'user_id': file_user_id,
-                            'date': f"{date_part[:4]}-{date_part[4:6]}-{date_part[6:8]}",
-                            'time': f"{time_part[:2]}:{time_part[2:4]}:{time_part[4:6]}",
-                            'size_bytes': stat.st_size,
-                            'modified_time': datetime.fromtimestamp(stat.st_mtime).isoformat()
-                        })
+                    stat = entry.stat()
+                    files_info.append({
+                        'filename': entry.name,
+                        'filepath': entry.path,
+                        'user_id': file_user_id,
+                        'date': f"{date_part[:4]}-{date_part[4:6]}-{date_part[6:8]}",
+                        'time': f"{time_part[:2]}:{time_part[2:4]}:{time_part[4:6]}",
+                        'size_bytes': stat.st_size,
+                        'modified_time': datetime.fromtimestamp(stat.st_mtime).isoformat()
+                    })
                 except Exception as e:
                     pass
         files_info.sort(key=lambda x: x['modified_time'], reverse=True)
+        if len(_list_cache) > 64:
+            _list_cache.clear()
+        _list_cache[(user_id, dir_mtime)] = files_info
         return files_info
     except Exception as e:
         return []
 
-def mark_email_with_category(access_token, email_id, category_name):
-    url = f"https://graph.microsoft.com/v1.0/me/messages/{email_id}"
-    response = make_graph_request(access_token, url, method='GET')
+GRAPH_BATCH_LIMIT = 20
+
+def mark_emails_with_category_batch(access_token, emails_to_mark, category_name):
+    """Apply a category to many emails via Graph $batch requests.
+
+    emails_to_mark is a list of (email_id, current_categories) pairs; passing
+    the categories the caller already fetched avoids a per-email GET before
+    each PATCH.
+    """
+    url = f"{GRAPH_BASE}/$batch"
+    all_succeeded = True
+    for chunk_start in range(0, len(emails_to_mark), GRAPH_BATCH_LIMIT):
+        chunk = emails_to_mark[chunk_start:chunk_start + GRAPH_BATCH_LIMIT]
+        batch_requests = []
+        for i, (email_id, current_categories) in enumerate(chunk):
+            categories = list(current_categories or [])
+            if category_name not in categories:
+                categories.append(category_name)
+            batch_requests.append({
+                'id': str(i),
+                'method': 'PATCH',
+                'url': f'/me/messages/{email_id}',
+                'headers': {'Content-Type': 'application/json'},
+                'body': {'categories': categories}
+            })
+        response = make_graph_request(access_token, url, method='POST', data={'requests': batch_requests})
+        if not response or response.status_code != 200:
+            all_succeeded = False
+            continue
+        for result in response.json().get('responses', []):
+            if result.get('status', 500) >= 400:
+                all_succeeded = False
+    return all_succeeded
+
+def mark_email_with_category(access_token, email_id, category_name, known_categories=None):
+    """Tag one email, skipping the read when the caller already knows its
+    categories (the fetch results carry them)."""
+    url = f"{GRAPH_BASE}/me/messages/{email_id}"
+    if known_categories is None:
+        # Only the category list is needed; without $select Graph returns
+        # the full message including the HTML body
+        response = make_graph_request(access_token, url, method='GET', params={'$select': 'categories'})
+        if not response or response.status_code != 200:
+            return False
+        known_categories = response.json().get('categories', [])
+    current_categories = list(known_categories)
+    if category_name not in current_categories:
+        current_categories.append(category_name)
+    update_data = {
+        "categories": current_categories
+    }
+    update_response = make_graph_request(access_token, url, method='PATCH', data=update_data)
+    return bool(update_response) and update_response.status_code == 200
+
+_tag_pattern = re.compile(r'<[^<]+?>')
+_archive_name_pattern = re.compile(r'^emails_(.+)_(\d{8})_(\d{6})\.jsonl?(?:\.gz)?$')
+
+# lxml's C-level text_content() beats regex stripping on real HTML and also
+# resolves entities; fall back to the regex when it is not installed
+try:
+    import lxml.html as _lxml_html
+except ImportError:
+    _lxml_html = None
+
+def extract_email_content(email_body, body_type, max_chars=4096):
+    if not email_body:
+        return ''
+    if body_type != 'html' or '<' not in email_body:
+        # Plain text, or HTML-labeled content with no tags to strip -
+        # the '<' scan is a C-level substring check, far cheaper than
+        # spinning up the parser or regex on clean bodies
+        return email_body[:max_chars].strip()
+    # Tag stripping only shrinks the text, so bounding the raw markup at
+    # 4x the budget keeps the pass cheap on multi-MB newsletters
+    # while still yielding max_chars of visible text in practice
+    markup = email_body[:max_chars * 4]
+    if _lxml_html is not None:
+        try:
+            return _lxml_html.fromstring(markup).text_content().strip()[:max_chars]
+        except Exception:
+            pass
+    return _tag_pattern.sub('', markup).strip()[:max_chars]
+
+def _fetch_mime_many(access_token, email_ids, graph_base):
+    """Fetch raw MIME for several messages in one $batch call per 20.
+
+    One POST replaces up to twenty /$value round trips. Graph
+    base64-encodes non-JSON sub-response bodies; the encoded string is kept
+    as-is, since it only gets persisted to the email archive - decoding to
+    text here would hold a second full copy of every MIME body in memory
+    (and choke on binary attachments) for no reader's benefit.
+    Returns {email_id: base64_mime_or_None}."""
+    results = {email_id: None for email_id in email_ids}
+    for chunk_start in range(0, len(email_ids), GRAPH_BATCH_LIMIT):
+        chunk = email_ids[chunk_start:chunk_start + GRAPH_BATCH_LIMIT]
+        batch_requests = [
+            {
+                'id': str(i),
+                'method': 'GET',
+                'url': f'/me/messages/{email_id}/$value',
+                'headers': {'Accept': 'application/octet-stream'}
+            }
+            for i, email_id in enumerate(chunk)
+        ]
+        response = make_graph_request(access_token, f"{graph_base}/$batch", method='POST',
+                                      data={'requests': batch_requests})
+        if not response or response.status_code != 200:
+            continue
+        for sub_response in response.json().get('responses', []):
+            if sub_response.get('status') == 200 and sub_response.get('body'):
+                try:
+                    results[chunk[int(sub_response['id'])]] = sub_response['body']
+                except Exception:
+                    pass
+    return results
+
+def _build_email(email_data, mime_content):
+    return {
+        'id': email_data['id'],
+        'subject': email_data.get('subject', 'No Subject'),
+        'sender': email_data.get('from', {}).get('emailAddress', {}).get('address', 'Unknown Sender'),
+        'content': email_data.get('body', {}).get('content', 'No content available'),
+        'bodyType': email_data.get('body', {}).get('contentType', 'text'),
+        'receivedDateTime': email_data.get('receivedDateTime', ''),
+        'categories': email_data.get('categories', []),
+        'mime': mime_content
+    }
+
+# Upper bound on messages gathered per fetch; pages stop once reached so a
+# busy inbox cannot balloon a scheduler tick.
+EMAIL_FETCH_MAX = 100
+
+def _collect_pages(access_token, response):
+    """Accumulate listing results across Graph's @odata.nextLink pages."""
+    emails = []
+    while True:
+        payload = response.json()
+        emails.extend(payload.get('value', []))
+        next_link = payload.get('@odata.nextLink')
+        if not next_link or len(emails) >= EMAIL_FETCH_MAX:
+            return emails[:EMAIL_FETCH_MAX]
+        response = make_graph_request(access_token, next_link, method='GET')
+        if not response or response.status_code != 200:
+            return emails
+
+def _fetch_inbox_page(access_token, params):
+    """Fetch the inbox listing, falling back to the beta endpoint when
+    v1.0 answers 401. Returns (graph_base, emails) so the caller knows which
+    API version to use for follow-up requests; graph_base is None on
+    failure."""
+    response = make_graph_request(access_token, f"{GRAPH_BASE}/me/messages", method='GET', params=params)
     if response and response.status_code == 200:
-        email_data = response.json()
-        current_categories = email_data.get('categories', [])
-        if category_name not in current_categories:
-            current_categories.append(category_name)
-        update_data = {
-            "categories": current_categories
-        }
-        update_response = make_graph_request(access_token, url, method='PATCH', data=update_data)
-        return update_response and update_response.status_code == 200
-    return False
-
-def extract_email_content(email_body, body_type):
-    if body_type == 'html':
-        import re
-        text = re.sub('<[^<]+?>', '', email_body)
-        return text.strip()
-    else:
-        return email_body.strip()
+        return GRAPH_BASE, _collect_pages(access_token, response)
+    if response and response.status_code == 401:
+        beta_url = f"{GRAPH_BETA}/me/mailFolders/inbox/messages"
+        beta_response = make_graph_request(access_token, beta_url, method='GET', params=params)
+        if beta_response and beta_response.status_code == 200:
+            return GRAPH_BETA, _collect_pages(access_token, beta_response)
+        return None, []
+    handle_outlook_api_error(response)
+    return None, []
 
-def fetch_emails_with_mime(user_id, days=7):
-    access_token = get_token_from_cache(user_id)
+def fetch_emails_with_mime(user_id, days=7, since=None, include_mime=True, oldest_first=False):
+    """Fetch new inbox messages, optionally with their raw MIME.
+
+    The listing already carries the body the classifier reads; the MIME
+    copy exists only for the on-disk archive, so callers that never touch
+    it (the scheduler) pass include_mime=False and skip transferring every
+    message a second time.
+
+    Callers that advance a cursor past max(receivedDateTime) of the result
+    must pass oldest_first=True: with more than EMAIL_FETCH_MAX matches (or
+    a failed page mid-walk) the truncated ascending list keeps the oldest
+    unprocessed messages, so the cursor only moves past what was actually
+    handled and the rest arrive next tick. A descending listing would keep
+    the newest and the cursor would jump the dropped ones forever."""
+    access_token = current_access_token(user_id)
     if not access_token:
         return []
     try:
-        date_from = (datetime.now() - timedelta(days=days)).isoformat() + 'Z'
-        url = "https://graph.microsoft.com/v1.0/me/messages"
+        if since:
+            # Caller knows the newest message it already processed; only ask
+            # Graph for anything strictly newer
+            filter_clause = f"receivedDateTime gt {since}"
+        else:
+            date_from = (datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            filter_clause = f"receivedDateTime ge {date_from}"
         params = {
-            '$filter': f"receivedDateTime ge {date_from}",
-            '$top': 10,
-            '$orderby': 'receivedDateTime desc',
-            '$select': 'id,subject,from,receivedDateTime,body,categories'
+            '$filter': filter_clause,
+            '$top': 50,
+            '$orderby': 'receivedDateTime asc' if oldest_first else 'receivedDateTime desc',
+            '$select': EMAIL_SELECT
         }
-        response = make_graph_request(access_token, url, method='GET', params=params)
-        if response and response.status_code == 200:
-            emails_data = response.json().get('value', [])
-            emails = []
-            for email_data in emails_data:
-                email_id = email_data['id']
-                mime_url = f"https://graph.microsoft.com/v1.0/me/messages/{email_id}/$value"
-                mime_headers = {
-                    'Authorization': f'Bearer {access_token}',
-                    'Accept': 'application/octet-stream'
-                }
-                mime_resp = requests.get(mime_url, headers=mime_headers, timeout=30)
-                mime_content = mime_resp.text if mime_resp.status_code == 200 else None
-                email = {
-                    'id': email_id,
-                    'subject': email_data.get('subject', 'No Subject'),
-                    'sender': email_data.get('from', {}).get('emailAddress', {}).get('address', 'Unknown Sender'),
-                    'content': email_data.get('body', {}).get('content', 'No content available'),
-                    'bodyType': email_data.get('body', {}).get('contentType', 'text'),
-                    'receivedDateTime': email_data.get('receivedDateTime', ''),
-                    'categories': email_data.get('categories', []),
-                    'mime': mime_content
-                }
-                emails.append(email)
-            filepath = save_emails_to_json(user_id, emails)
-            return emails
-        elif response and response.status_code == 401:
-            beta_url = "https://graph.microsoft.com/beta/me/mailFolders/inbox/messages"
-            beta_response = make_graph_request(access_token, beta_url, method='GET', params=params)
-            if beta_response and beta_response.status_code == 200:
-                emails_data = beta_response.json().get('value', [])
-                emails = []
-                for email_data in emails_data:
-                    email_id = email_data['id']
-                    mime_url = f"https://graph.microsoft.com/beta/me/messages/{email_id}/$value"
-                    mime_headers = {
-                        'Authorization': f'Bearer {access_token}',
-                        'Accept': 'application/octet-stream'
-                    }
-                    mime_resp = requests.get(mime_url, headers=mime_headers, timeout=30)
-                    mime_content = mime_resp.text if mime_resp.status_code == 200 else None
-                    email = {
-                        'id': email_id,
-                        'subject': email_data.get('subject', 'No Subject'),
-                        'sender': email_data.get('from', {}).get('emailAddress', {}).get('address', 'Unknown Sender'),
-                        'content': email_data.get('body', {}).get('content', 'No content available'),
-                        'bodyType': email_data.get('body', {}).get('contentType', 'text'),
-                        'receivedDateTime': email_data.get('receivedDateTime', ''),
-                        'categories': email_data.get('categories', []),
-                        'mime': mime_content
-                    }
-                    emails.append(email)
-                filepath = save_emails_to_json(user_id, emails)
-                return emails
-            else:
-                return []
-        else:
-            handle_outlook_api_error(response)
+        graph_base, emails_data = _fetch_inbox_page(access_token, params)
+        if graph_base is None:
             return []
+        if include_mime:
+            mime_by_id = _fetch_mime_many(access_token, [e['id'] for e in emails_data], graph_base)
+        else:
+            mime_by_id = {}
+        emails = [_build_email(e, mime_by_id.get(e['id'])) for e in emails_data]
+        # Fire-and-forget: the caller never reads the archive it just wrote,
+        # and atexit drains the pool so shutdown doesn't truncate a file
+        _io_pool.submit(save_emails_to_json, user_id, emails)
+        return emails
     except Exception as e:
         return []
\ No newline at end of file